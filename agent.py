@@ -1,38 +1,100 @@
-from fastapi import FastAPI, Depends, HTTPException, status, Security, Request
-from fastapi.security.api_key import APIKeyHeader
-from fastapi.middleware.cors import CORSMiddleware
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import JSONResponse, Response
 
-from pydantic import BaseModel
-from typing import Dict
+from pydantic import BaseModel, ValidationError
+from typing import Dict, List, Optional
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from itertools import islice
+import hmac
 import logging
-from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
 import os
+import queue
+import sys
+import threading
+import orjson
 import uvicorn
 import time
+from urllib.parse import parse_qsl
 from dotenv import load_dotenv
 
 load_dotenv()
 
 # ---------------- Logging Setup ---------------- #
+# Per-request logs are emitted at DEBUG; set LOG_LEVEL=DEBUG to see them.
 logging.basicConfig(
-    level=logging.INFO,
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),
     format="%(asctime)s - [%(levelname)s] - %(name)s - %(message)s",
 )
 logger = logging.getLogger("coliving-ai-os")
 
+
+@asynccontextmanager
+async def lifespan(app):
+    """While serving, route root log records through a queue drained by a background thread.
+
+    Handlers only enqueue records, so the event loop never blocks on stderr writes.
+    """
+    root = logging.getLogger()
+    handlers = root.handlers[:]
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    root.handlers = [QueueHandler(log_queue)]
+    listener.start()
+    try:
+        yield
+    finally:
+        listener.stop()
+        root.handlers = handlers
+
 # ---------------- Security Setup ---------------- #
 API_KEY = os.getenv("API_KEY")
 API_KEY_NAME = os.getenv("API_KEY_NAME")
-api_key_header = APIKeyHeader(name=API_KEY_NAME, auto_error=True)
+API_KEY_BYTES = (API_KEY or "").encode()
+API_KEY_HEADER = (API_KEY_NAME or "").lower().encode()  # ASGI header names are lowercase bytes
+PROTECTED_PATH_PREFIX = "/coliving-ai-os/api/raw-user-message"
+
+# Pre-built 401 response. Middlewares wrapping `send` copy messages instead of
+# mutating them, so these can be sent as-is on every rejection.
+UNAUTHORIZED_BODY = b'{"detail":"Invalid or missing API Key"}'
+UNAUTHORIZED_START = {
+    "type": "http.response.start",
+    "status": 401,
+    "headers": (
+        (b"content-type", b"application/json"),
+        (b"content-length", b"%d" % len(UNAUTHORIZED_BODY)),
+    ),
+}
+UNAUTHORIZED_MESSAGE = {"type": "http.response.body", "body": UNAUTHORIZED_BODY}
+
+def has_valid_api_key(scope) -> bool:
+    """True if the request's API key header matches API_KEY (constant-time compare)."""
+    for name, value in scope["headers"]:
+        if name == API_KEY_HEADER:
+            return bool(API_KEY_BYTES) and hmac.compare_digest(value, API_KEY_BYTES)
+    return False
+
+class APIKeyMiddleware:
+    """Pure ASGI middleware that rejects protected requests without a valid API key header."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith(PROTECTED_PATH_PREFIX):
+            await self.app(scope, receive, send)
+            return
+
+        if has_valid_api_key(scope):
+            await self.app(scope, receive, send)
+            return
 
-def get_api_key(api_key: str = Security(api_key_header)):
-    if api_key != API_KEY:
         logger.warning("Unauthorized access attempt detected.")
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Invalid or missing API Key",
-        )
-    return api_key
+        await send(UNAUTHORIZED_START)
+        await send(UNAUTHORIZED_MESSAGE)
 
 # ---------------- Data Model ---------------- #
 class PayloadModel(BaseModel):
@@ -56,75 +118,318 @@ class UserMessage(BaseModel):
 
 
 # ---------------- FastAPI App ---------------- #
+class ORJSONResponse(JSONResponse):
+    """JSONResponse rendered with orjson instead of the stdlib json module."""
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
+
+
 app = FastAPI(
     title="Coliving AI OS API",
     description="API for managing raw user messages securely.",
     version="1.0.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan,
 )
 
+# Registered before CORS so preflights and 401 responses still get CORS headers.
+app.add_middleware(APIKeyMiddleware)
+
 # ---------------- CORS Setup ---------------- #
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],  # In production, restrict this
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+# Set CORS_ENABLED=0 when a gateway in front of the API already handles CORS.
+CORS_ENABLED = os.getenv("CORS_ENABLED", "1") == "1"
+CORS_ALLOW_ORIGIN = (b"access-control-allow-origin", b"*")  # In production, restrict this
+CORS_PREFLIGHT_START = {
+    "type": "http.response.start",
+    "status": 200,
+    "headers": (
+        CORS_ALLOW_ORIGIN,
+        (b"access-control-allow-methods", b"DELETE, GET, HEAD, OPTIONS, PATCH, POST, PUT"),
+        (b"access-control-allow-headers", b"*"),
+        (b"access-control-max-age", b"600"),
+        (b"content-length", b"0"),
+    ),
+}
+EMPTY_BODY_MESSAGE = {"type": "http.response.body", "body": b""}
+
+class StaticCORSMiddleware:
+    """Pure ASGI middleware for an allow-all CORS policy built from pre-encoded headers.
+
+    Preflight requests are answered directly; every other response gets the
+    static allow-origin header appended.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        if scope["method"] == "OPTIONS" and any(
+            name == b"access-control-request-method" for name, _ in scope["headers"]
+        ):
+            await send(CORS_PREFLIGHT_START)
+            await send(EMPTY_BODY_MESSAGE)
+            return
+
+        async def send_with_cors(message):
+            if message["type"] == "http.response.start":
+                message = {**message, "headers": [*message.get("headers", ()), CORS_ALLOW_ORIGIN]}
+            await send(message)
+
+        await self.app(scope, receive, send_with_cors)
+
+
+if CORS_ENABLED:
+    app.add_middleware(StaticCORSMiddleware)
 
 # ---------------- Middleware for Latency ---------------- #
-latency_stats = {"count": 0, "total_ms": 0.0}
+class LatencyStats:
+    """Request latency totals kept per thread and summed only when read.
+
+    Each thread writes to its own ``[count, total_ms]`` bucket, so recording is
+    free of locks and cross-thread writes; the lock only guards registration.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._buckets: List[list] = []
+        self._lock = threading.Lock()
+
+    def _bucket(self) -> list:
+        try:
+            return self._local.bucket
+        except AttributeError:
+            bucket = self._local.bucket = [0, 0.0]
+            with self._lock:
+                self._buckets.append(bucket)
+            return bucket
+
+    def record(self, process_time_ms: float) -> None:
+        bucket = self._bucket()
+        bucket[0] += 1
+        bucket[1] += process_time_ms
+
+    def average_ms(self) -> float:
+        with self._lock:
+            buckets = list(self._buckets)
+        count = sum(bucket[0] for bucket in buckets)
+        total_ms = sum(bucket[1] for bucket in buckets)
+        return round(total_ms / count, 2) if count > 0 else 0
+
+
+latency_stats = LatencyStats()
+
+PROCESS_TIME_HEADER = b"x-process-time-ms"
+
+class ProcessTimeMiddleware:
+    """Pure ASGI middleware that stamps X-Process-Time-ms on every HTTP response."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start_time = time.perf_counter()
 
-@app.middleware("http")
-async def add_process_time_header(request: Request, call_next):
-    start_time = time.perf_counter()
-    response = await call_next(request)
-    process_time = (time.perf_counter() - start_time) * 1000
-    response.headers["X-Process-Time-ms"] = f"{process_time:.2f}"
+        async def send_with_process_time(message):
+            if message["type"] == "http.response.start":
+                process_time = (time.perf_counter() - start_time) * 1000
+                # bytes %-formatting skips the str -> bytes encode step
+                header = (PROCESS_TIME_HEADER, b"%.2f" % process_time)
+                message = {**message, "headers": [*message.get("headers", ()), header]}
 
-    latency_stats["count"] += 1
-    latency_stats["total_ms"] += process_time
+                latency_stats.record(process_time)
 
-    logger.info(f"Request {request.url.path} took {process_time:.2f} ms")
-    return response
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Request %s took %.2f ms", scope["path"], process_time)
+            await send(message)
+
+        await self.app(scope, receive, send_with_process_time)
+
+
+app.add_middleware(ProcessTimeMiddleware)
+
+
+# ---------------- Profiling (opt-in) ---------------- #
+PROFILING = os.getenv("PROFILING") == "1"
+
+class ProfilerMiddleware:
+    """Pure ASGI middleware that answers ``?profile=1`` requests with a pyinstrument HTML report.
+
+    Only registered when PROFILING=1; pyinstrument is not a runtime requirement.
+    Reports expose code paths, so profiling also requires a valid API key on every
+    route; other requests pass through untouched (and protected ones then get a 401).
+    """
+
+    def __init__(self, app):
+        from pyinstrument import Profiler
+
+        self.app = app
+        self.profiler_class = Profiler
+
+    async def __call__(self, scope, receive, send):
+        if (
+            scope["type"] != "http"
+            or (b"profile", b"1") not in parse_qsl(scope["query_string"])
+            or not has_valid_api_key(scope)
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        async def discard(message):
+            pass
+
+        profiler = self.profiler_class(interval=0.001, async_mode="enabled")
+        profiler.start()
+        try:
+            await self.app(scope, receive, discard)
+        finally:
+            profiler.stop()
+
+        body = profiler.output_html().encode()
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", b"text/html; charset=utf-8"),
+                (b"content-length", str(len(body)).encode()),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+
+if PROFILING:
+    app.add_middleware(ProfilerMiddleware)
 
 
 # In-memory storage (replace with DB in production)
-db: Dict[int, UserMessage] = {}
+MAX_MESSAGES = int(os.getenv("MAX_MESSAGES", 100_000))
+if MAX_MESSAGES < 1:
+    raise ValueError(f"MAX_MESSAGES must be at least 1, got {MAX_MESSAGES}")
+
+
+@dataclass
+class MsgStore:
+    """Message store holding each message once, as its orjson-encoded row, addressed by id.
+
+    Capped at ``max_size`` messages; once full, the least recently used message
+    is evicted and its row reused for the incoming one. ``index`` tracks recency
+    only; listings follow ``order``, which keeps first-insertion order.
+    """
+
+    max_size: int = MAX_MESSAGES
+    encoded: List[bytes] = field(default_factory=list)  # orjson bytes per row, built on write
+    index: "OrderedDict[int, int]" = field(default_factory=OrderedDict)  # message id -> row, LRU first
+    order: Dict[int, int] = field(default_factory=dict)  # message id -> row, insertion order
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def put(self, message: UserMessage) -> None:
+        encoded = orjson.dumps(message.model_dump())
+        row = self.index.get(message.id)
+        if row is None and len(self.index) >= self.max_size:
+            evicted_id, row = self.index.popitem(last=False)
+            del self.order[evicted_id]
+        if row is None:
+            self.index[message.id] = self.order[message.id] = len(self.encoded)
+            self.encoded.append(encoded)
+        else:
+            self.index[message.id] = self.order[message.id] = row
+            self.index.move_to_end(message.id)
+            self.encoded[row] = encoded
+
+    def get_encoded(self, message_id: int) -> Optional[bytes]:
+        row = self.index.get(message_id)
+        if row is None:
+            return None
+        self.index.move_to_end(message_id)
+        return self.encoded[row]
+
+    def page_encoded(self, skip: int, limit: int) -> bytes:
+        """JSON array of the requested rows, spliced from the cached per-row bytes."""
+        rows = islice(self.order.values(), skip, skip + limit)
+        return b"[" + b",".join([self.encoded[row] for row in rows]) + b"]"
+
+
+db = MsgStore()
 
 
 # ---------------- Routes ---------------- #
-@app.post("/coliving-ai-os/api/raw-user-message", dependencies=[Depends(get_api_key)])
-async def post_user_message(message: UserMessage):
+def inline_json_schema(model) -> dict:
+    """JSON schema for `model` with nested-model $refs inlined, usable inside openapi_extra."""
+    schema = model.model_json_schema()
+    defs = schema.pop("$defs", {})
+
+    def resolve(node):
+        if isinstance(node, dict):
+            if "$ref" in node:
+                return resolve(defs[node["$ref"].rsplit("/", 1)[-1]])
+            return {key: resolve(value) for key, value in node.items()}
+        if isinstance(node, list):
+            return [resolve(item) for item in node]
+        return node
+
+    return resolve(schema)
+
+
+# The body is validated by hand from raw bytes, so describe it for the docs explicitly.
+@app.post(
+    "/coliving-ai-os/api/raw-user-message",
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {"application/json": {"schema": inline_json_schema(UserMessage)}},
+        }
+    },
+)
+async def post_user_message(request: Request):
     """POST a new user message"""
-    message.receive_At = int(time.time() * 1000)  # ms
+    # Validate the raw body in one pass instead of json.loads + model validation.
+    try:
+        message = UserMessage.model_validate_json(await request.body())
+    except ValidationError as exc:
+        raise RequestValidationError(
+            [{**error, "loc": ("body", *error["loc"])} for error in exc.errors(include_url=False)]
+        )
+    now_ns = time.time_ns()  # single clock read for both timestamps
+    message.receive_At = now_ns // 1_000_000  # ms
     message.tsDifference = message.receive_At - message.send_At  # ms
-    db[message.id] = message
-    logger.info(
-        f"Message stored: id={message.id}, sender={message.sender_id}, type={message.type}, latency={message.tsDifference}s"
+    db.put(message)
+    logger.debug(
+        "Message stored: id=%s, sender=%s, type=%s, latency=%sms",
+        message.id, message.sender_id, message.type, message.tsDifference,
     )
     return {
         "status": "success",
         "message_id": message.id,
-        "stored_at": int(datetime.utcnow().timestamp()),
+        "stored_at": now_ns // 1_000_000_000,
         "latency_seconds": message.tsDifference,
     }
 
 
-@app.get("/coliving-ai-os/api/raw-user-message/{message_id}", dependencies=[Depends(get_api_key)])
+@app.get("/coliving-ai-os/api/raw-user-message/{message_id}", response_model=None)
 async def fetch_user_message(message_id: int):
     """GET a user message by ID"""
-    if message_id not in db:
-        logger.error(f"Message with id={message_id} not found.")
+    encoded = db.get_encoded(message_id)
+    if encoded is None:
+        logger.debug("Message with id=%s not found.", message_id)
         raise HTTPException(status_code=404, detail="Message not found")
-    logger.info(f"Message fetched: id={message_id}")
-    return db[message_id]
+    logger.debug("Message fetched: id=%s", message_id)
+    return Response(content=encoded, media_type="application/json")
 
 
-@app.get("/coliving-ai-os/api/raw-user-message", dependencies=[Depends(get_api_key)])
-async def fetch_messages(skip: int = 0, limit: int = 200):
+@app.get("/coliving-ai-os/api/raw-user-message", response_model=None)
+async def fetch_messages(skip: int = Query(0, ge=0), limit: int = Query(200, ge=0)):
     """GET paginated messages"""
-    messages = list(db.values())
-    return messages[skip: skip + limit]
+    return Response(content=db.page_encoded(skip, limit), media_type="application/json")
 
 
 # ---------------- Health Check ---------------- #
@@ -133,15 +438,51 @@ async def health_check():
     """Check API health and server status"""
     return {
         "status": 1,
-        "timestamp": datetime.utcnow(),
+        "timestamp": time.time(),
         "message_count": len(db),
-        "avg_latency_ms": round(latency_stats["total_ms"] / latency_stats["count"], 2) if latency_stats["count"] > 0 else 0
+        "avg_latency_ms": latency_stats.average_ms(),
     }
 
+
+# ---------------- OpenAPI ---------------- #
+def openapi_with_api_key() -> dict:
+    """FastAPI's schema plus the API key scheme APIKeyMiddleware enforces on protected paths."""
+    if app.openapi_schema is None:
+        schema = FastAPI.openapi(app)
+        schema.setdefault("components", {})["securitySchemes"] = {
+            "APIKeyHeader": {"type": "apiKey", "in": "header", "name": API_KEY_NAME or ""},
+        }
+        for path, operations in schema["paths"].items():
+            if path.startswith(PROTECTED_PATH_PREFIX):
+                for operation in operations.values():
+                    operation["security"] = [{"APIKeyHeader": []}]
+    return app.openapi_schema
+
+
+app.openapi = openapi_with_api_key
+
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 4001))
     host = os.environ.get("HOST", "127.0.0.1")
-    uvicorn.run("agent:app", host=host, port=port, reload=True)
+    reload = os.environ.get("RELOAD", "0") == "1"  # dev only
+    loop = "asyncio" if sys.platform == "win32" else "uvloop"  # uvloop has no Windows build
+    # Each worker is a separate process with its own event loop and its own in-memory
+    # `db`, so with WORKERS > 1 messages are not shared between workers. Only scale out
+    # once storage lives outside the process (e.g. Redis or SQLite in WAL mode).
+    workers = os.environ.get("WORKERS", "1")
+    workers = (os.cpu_count() or 1) if workers == "auto" else int(workers)
+    if workers > 1:
+        logger.warning("Running %d workers: the in-memory message store is per worker.", workers)
+    uvicorn.run(
+        "agent:app",
+        host=host,
+        port=port,
+        loop=loop,
+        http="httptools",
+        reload=reload,
+        workers=workers,
+        access_log=False,
+    )
 
 
 
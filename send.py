@@ -1,5 +1,6 @@
-import json
-import requests
+import asyncio
+import httpx
+import orjson
 import logging
 import time
 from pathlib import Path
@@ -13,18 +14,68 @@ logging.basicConfig(
 logger = logging.getLogger("sender")
 
 # ---------------- Config ---------------- #
-API_ENDPOINT = "http://127.0.0.1:4001/coliving-ai-os/api/raw-user-message/"
+API_ENDPOINT = "http://127.0.0.1:4001/coliving-ai-os/api/raw-user-message"
 API_KEY = "supersecretapikey123"
 HEADERS = {
     "Content-Type": "application/json",
     "X-API-KEY": API_KEY,
 }
+BATCH_SIZE = 32  # concurrent requests in flight per user
+# Keep every batch connection alive between batches and users (httpx keeps only 20 by default)
+POOL_LIMITS = httpx.Limits(max_connections=BATCH_SIZE, max_keepalive_connections=BATCH_SIZE)
 
-# ---------------- Sender Function ---------------- #
-def send_messages_from_json(file_path: str, user_limit: int = 5, msg_limit: int = 10):
+# ---------------- Sender Functions ---------------- #
+async def send_message(client: httpx.AsyncClient, msg: Dict[str, Any], user_ns: str):
+    """Sends a single message and logs client round-trip and server latency."""
+    try:
+        msg_to_send = dict(msg)  # copy
+        msg_to_send["send_At"] = time.time_ns() // 1_000_000
+
+        # Measure round-trip time
+        start = time.perf_counter()
+        response = await client.post(API_ENDPOINT, content=orjson.dumps(msg_to_send))
+        end = time.perf_counter()
+
+        round_trip_ms = (end - start) * 1000
+        server_latency_raw = response.headers.get("X-Process-Time-ms")
+        try:
+            server_latency = float(server_latency_raw) if server_latency_raw else None
+        except ValueError:
+            server_latency = None
+
+        if response.status_code == 200:
+            logger.info(
+                f"✅ Sent message id={msg.get('id')} for user {user_ns} "
+                f"| Client RTT={round_trip_ms:.2f} ms "
+                f"| Server latency={server_latency:.2f} ms"
+                if server_latency is not None else
+                f"✅ Sent message id={msg.get('id')} for user {user_ns} "
+                f"| Client RTT={round_trip_ms:.2f} ms "
+                f"| Server latency=N/A"
+            )
+        else:
+            logger.error(
+                f"❌ Failed to send message id={msg.get('id')} for user {user_ns} "
+                f"| Status={response.status_code}, Response={response.text} "
+                f"| Client RTT={round_trip_ms:.2f} ms "
+                f"| Server latency={server_latency:.2f} ms"
+                if server_latency is not None else
+                f"❌ Failed to send message id={msg.get('id')} for user {user_ns} "
+                f"| Status={response.status_code}, Response={response.text} "
+                f"| Client RTT={round_trip_ms:.2f} ms "
+                f"| Server latency=N/A"
+            )
+    except Exception as e:
+        logger.exception(f"💥 Error sending message id={msg.get('id')}: {e}")
+
+
+async def send_messages_from_json(file_path: str, user_limit: int = 5, msg_limit: int = 10):
     """
     Reads messages from a JSON file and sends them to the API endpoint.
-    
+
+    All requests share one pooled AsyncClient and each user's messages are
+    sent concurrently in batches of BATCH_SIZE.
+
     Args:
         file_path: Path to the JSON file containing chat history.
         user_limit: Max number of users to process.
@@ -35,70 +86,31 @@ def send_messages_from_json(file_path: str, user_limit: int = 5, msg_limit: int
         logger.error(f"❌ JSON file not found: {file_path}")
         return
 
-    with open(path, "r", encoding="utf-8") as f:
-        try:
-            data: list[Dict[str, Any]] = json.load(f)
-        except json.JSONDecodeError as e:
-            logger.error(f"❌ Failed to parse JSON: {e}")
-            return
-
-    # Expecting a list at the root
-    for idx, user_entry in enumerate(data):
-        if idx >= user_limit:
-            break
-
-        user_ns = user_entry.get("user_ns", "unknown")
-        chat_history = user_entry.get("chat_history", [])
-
-        logger.info(f"➡️ Processing user_ns={user_ns}, total_messages={len(chat_history)}")
-
-        for msg in chat_history[:msg_limit]:
-            try:
-                msg_to_send = dict(msg)  # copy
-                send_At_ts = send_At_ts = int(time.time() * 1000)
-                msg_to_send["send_At"] = send_At_ts
-
-                print(f"payload:{msg_to_send}, type:{type(msg_to_send)}")
-
-                # Measure round-trip time
-                start = time.perf_counter()
-                response = requests.post(API_ENDPOINT, headers=HEADERS, json=msg_to_send)
-                end = time.perf_counter()
-
-                round_trip_ms = (end - start) * 1000
-                server_latency_raw = response.headers.get("X-Process-Time-ms")
-                try:
-                    server_latency = float(server_latency_raw) if server_latency_raw else None
-                except ValueError:
-                    server_latency = None
-
-                if response.status_code == 200:
-                    logger.info(
-                        f"✅ Sent message id={msg.get('id')} for user {user_ns} "
-                        f"| Client RTT={round_trip_ms:.2f} ms "
-                        f"| Server latency={server_latency:.2f} ms"
-                        if server_latency is not None else
-                        f"✅ Sent message id={msg.get('id')} for user {user_ns} "
-                        f"| Client RTT={round_trip_ms:.2f} ms "
-                        f"| Server latency=N/A"
-                    )
-                else:
-                    logger.error(
-                        f"❌ Failed to send message id={msg.get('id')} for user {user_ns} "
-                        f"| Status={response.status_code}, Response={response.text} "
-                        f"| Client RTT={round_trip_ms:.2f} ms "
-                        f"| Server latency={server_latency:.2f} ms"
-                        if server_latency is not None else
-                        f"❌ Failed to send message id={msg.get('id')} for user {user_ns} "
-                        f"| Status={response.status_code}, Response={response.text} "
-                        f"| Client RTT={round_trip_ms:.2f} ms "
-                        f"| Server latency=N/A"
-                    )
-            except Exception as e:
-                logger.exception(f"💥 Error sending message id={msg.get('id')}: {e}")
-        time.sleep(2)
+    try:
+        data: list[Dict[str, Any]] = orjson.loads(path.read_bytes())
+    except orjson.JSONDecodeError as e:
+        logger.error(f"❌ Failed to parse JSON: {e}")
+        return
+
+    async with httpx.AsyncClient(headers=HEADERS, limits=POOL_LIMITS) as client:
+        # Expecting a list at the root
+        for idx, user_entry in enumerate(data):
+            if idx >= user_limit:
+                break
+
+            user_ns = user_entry.get("user_ns", "unknown")
+            chat_history = user_entry.get("chat_history", [])
+
+            logger.info(f"➡️ Processing user_ns={user_ns}, total_messages={len(chat_history)}")
+
+            messages = chat_history[:msg_limit]
+            for i in range(0, len(messages), BATCH_SIZE):
+                await asyncio.gather(
+                    *(send_message(client, msg, user_ns) for msg in messages[i: i + BATCH_SIZE])
+                )
+            await asyncio.sleep(2)
 
 # ---------------- Main ---------------- #
 if __name__ == "__main__":
     file = r"C:\Users\User\TARUMT\project\Belive CoLiving\chat history\chat_history_2.json"
-    send_messages_from_json(file, user_limit=1, msg_limit=1)
\ No newline at end of file
+    asyncio.run(send_messages_from_json(file, user_limit=1, msg_limit=1))
\ No newline at end of file